@@ -2,8 +2,15 @@
 
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from multiprocessing import shared_memory
+import struct
+
 import pytest
 
+import flight_planner
+
 from flight_planner import (
     Flight,
     Itinerary,
@@ -12,6 +19,49 @@ from flight_planner import (
     find_cheapest_itinerary,
     MIN_LAYOVER_MINUTES,
     parse_time,
+    load_flights_txt,
+    load_indexed_graph,
+    write_indexed_schedule,
+    compile_graph,
+    compile_graph_streaming,
+    MemoryMeter,
+    find_earliest_itinerary_compiled,
+    find_cheapest_itinerary_compiled,
+    find_earliest_itinerary_periodic,
+    find_cheapest_itinerary_periodic,
+    next_departure,
+    parse_days,
+    parse_day_offset_time,
+    compact_flights,
+    SHARED_GRAPH_MAGIC,
+    SharedGraph,
+    parallel_search,
+    run_query,
+    compute_matrix,
+    earliest_arrivals_multi,
+    ReachabilityIndex,
+    build_reverse_graph,
+    find_latest_departure_itinerary,
+    find_latest_departure_itinerary_compiled,
+    find_earliest_itinerary_multi,
+    find_cheapest_itinerary_multi,
+    expand_airport_code,
+    find_round_trips,
+    GraphStats,
+    SearchContext,
+    ENGINES,
+    choose_engine,
+    ScheduleStore,
+    find_earliest_itinerary_within_budget,
+    fare_lower_bounds,
+    find_earliest_itinerary_anytime,
+    find_cheapest_itinerary_anytime,
+    SearchFilter,
+    FlightTags,
+    RadixHeap,
+    DialQueue,
+    PRIORITY_QUEUES,
+    BackgroundIndexer,
 )
 
 
@@ -251,3 +301,769 @@ def test_extremely_long_trip_multiple_legs():
     assert itin.origin == "A"
     assert itin.dest == "E"
     assert_valid_itinerary_times(itin)
+
+
+def test_indexed_schedule_lazy_graph_matches_and_loads_on_demand(tmp_path):
+    flights = [
+        f("A", "B", "F2", "10:00", "11:00", 100, 200, 300),
+        f("A", "B", "F1", "08:00", "09:00", 150, 250, 350),
+        f("B", "C", "F3", "10:30", "11:30", 100, 200, 300),
+        # An unrelated part of the network that an A->C search never reaches.
+        f("X", "Y", "F4", "08:00", "09:00", 100, 200, 300),
+        f("Y", "Z", "F5", "10:00", "11:00", 100, 200, 300),
+    ]
+    path = tmp_path / "indexed.txt"
+    write_indexed_schedule(flights, str(path))
+
+    # Still a plain TXT schedule, grouped by origin and sorted by departure.
+    assert len(load_flights_txt(str(path))) == len(flights)
+
+    lazy = load_indexed_graph(str(path))
+    assert set(lazy.keys()) == {"A", "B", "X", "Y"}
+    assert lazy.airports() == {"A", "B", "C", "X", "Y", "Z"}
+    assert "C" not in lazy
+    assert lazy.loaded_airports() == set()
+    assert [fl.flight_number for fl in lazy["A"]] == ["F1", "F2"]
+
+    itin = find_earliest_itinerary(lazy, "A", "C", parse_time("07:00"))
+    expected = find_earliest_itinerary(build_graph(flights), "A", "C", parse_time("07:00"))
+    assert itin == expected
+    assert lazy.loaded_airports() == {"A", "B"}
+
+
+def test_cache_counters_are_exact_under_threads(tmp_path):
+    flights = [f("A", "B", "F1", "08:00", "09:00", 1, 2, 3), f("B", "C", "F2", "10:00", "11:00", 1, 2, 3)]
+    path = tmp_path / "indexed.txt"
+    write_indexed_schedule(flights, str(path))
+    lazy = load_indexed_graph(str(path))
+    reach = ReachabilityIndex(compile_graph(build_graph(flights)))
+    lazy["A"]
+    reach.latest_departures(2)
+
+    def hammer(_):
+        for _ in range(2000):
+            lazy["A"]
+            reach.latest_departures(2)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(hammer, range(8)))
+    assert (lazy.hits, lazy.misses) == (16000, 1)
+    assert (reach.hits, reach.misses) == (16000, 1)
+
+
+def test_indexed_schedule_rejects_stale_index(tmp_path):
+    path = tmp_path / "indexed.txt"
+    write_indexed_schedule([f("A", "B", "F1", "08:00", "09:00", 1, 2, 3)], str(path))
+    with open(path, "a", encoding="utf-8") as out:
+        out.write("A C F9 07:00 08:00 1 2 3\n")
+    with pytest.raises(ValueError, match="stale"):
+        load_indexed_graph(str(path))
+
+    # An index from before the stamp was added is not trusted either.
+    write_indexed_schedule([f("A", "B", "F1", "08:00", "09:00", 1, 2, 3)], str(path))
+    idx = tmp_path / "indexed.txt.idx"
+    lines = idx.read_text(encoding="utf-8").splitlines(keepends=True)
+    idx.write_text("# flywise-index 1\n" + "".join(lines[1:]), encoding="utf-8")
+    with pytest.raises(ValueError, match="not a schedule index"):
+        load_indexed_graph(str(path))
+
+
+def test_compiled_graph_csr_layout():
+    flights = [
+        f("B", "C", "F3", "09:30", "10:30", 100, 200, 300),
+        f("A", "C", "F2", "10:00", "11:00", 110, 210, 310),
+        f("A", "B", "F1", "08:00", "09:00", 120, 220, 320),
+    ]
+    cg = compile_graph(build_graph(flights))
+
+    assert cg.codes == ["A", "B", "C"]
+    assert [cg.ids[c] for c in cg.codes] == [0, 1, 2]
+    assert cg.offsets == [0, 2, 3, 3]
+    # A's edges are sorted by departure.
+    assert [cg.flights[e].flight_number for e in cg.out_edges("A")] == ["F1", "F2"]
+    assert [cg.codes[cg.dest[e]] for e in cg.out_edges("A")] == ["B", "C"]
+    assert cg.fares[1] == [220, 210, 200]
+    assert list(cg.out_edges("C")) == []
+
+
+def test_compile_graph_streaming_matches_compile_graph():
+    flights = [
+        f("B", "C", "F3", "09:30", "10:30", 100, 200, 300),
+        f("A", "C", "F2", "10:00", "11:00", 110, 210, 310),
+        f("A", "B", "F1", "08:00", "09:00", 120, 220, 320),
+        f("A", "B", "F0", "08:00", "08:50", 130, 230, 330),
+    ]
+    cg = compile_graph(build_graph(flights))
+    streamed = compile_graph_streaming(iter(flights))
+
+    assert streamed.codes == cg.codes
+    assert list(streamed.offsets) == list(cg.offsets)
+    assert list(streamed.dest) == list(cg.dest)
+    assert list(streamed.depart) == list(cg.depart)
+    assert [list(row) for row in streamed.fares] == [list(row) for row in cg.fares]
+    assert list(streamed.flights) == list(cg.flights)
+    assert find_cheapest_itinerary_compiled(streamed, "A", "C", 0, "first") == \
+        find_cheapest_itinerary_compiled(cg, "A", "C", 0, "first")
+
+
+def test_memory_meter_reports_phases_against_budget():
+    meter = MemoryMeter(top=1)
+    try:
+        with meter.phase("load"):
+            blob = [bytes(1024) for _ in range(256)]
+        with meter.phase("search"):
+            pass
+    finally:
+        meter.stop()
+
+    assert [p.name for p in meter.phases] == ["load", "search"]
+    assert meter.phases[0].peak >= 256 * 1024
+    assert meter.peak >= meter.phases[0].peak
+    report = meter.report(budget=1)
+    assert "load" in report and "OVER budget" in report
+    del blob
+
+
+def test_compiled_searches_match_dict_searches():
+    flights = [
+        f("A", "B", "Fdirect", "08:00", "10:00", 400, 500, 900),
+        f("A", "X", "Fax", "08:00", "09:00", 150, 400, 800),
+        f("X", "B", "Fxb", "10:30", "11:30", 150, 400, 800),
+        f("X", "B", "Ftight", "09:30", "10:00", 50, 50, 50),  # layover too short
+        f("A", "B", "Flate", "12:00", "13:00", 100, 900, 900),
+    ]
+    graph = build_graph(flights)
+    cg = compile_graph(graph)
+    for dep in ("07:00", "08:30", "12:00", "13:00"):
+        t = parse_time(dep)
+        assert find_earliest_itinerary_compiled(cg, "A", "B", t) == find_earliest_itinerary(graph, "A", "B", t)
+        for cabin in ("economy", "business", "first"):
+            got = find_cheapest_itinerary_compiled(cg, "A", "B", t, cabin)
+            want = find_cheapest_itinerary(graph, "A", "B", t, cabin)
+            assert (got and got.total_price(cabin)) == (want and want.total_price(cabin))
+            if got is not None:
+                assert_valid_itinerary_times(got)
+
+    assert find_earliest_itinerary_compiled(cg, "B", "A", 0) is None
+    assert find_cheapest_itinerary_compiled(cg, "Q", "B", 0, "economy") is None
+
+    # start == dest: no earliest-arrival route, but an empty, free cheapest one.
+    t = parse_time("07:00")
+    assert find_earliest_itinerary_compiled(cg, "A", "A", t) == find_earliest_itinerary(graph, "A", "A", t)
+    reach = ReachabilityIndex(cg)
+    for epsilon in (0.0, 0.5):
+        want = find_cheapest_itinerary(graph, "A", "A", t, "economy", epsilon=epsilon)
+        assert want == Itinerary(flights=[])
+        assert find_cheapest_itinerary_compiled(cg, "A", "A", t, "economy", epsilon=epsilon) == want
+        assert find_cheapest_itinerary_compiled(cg, "A", "A", t, "economy", reach, epsilon) == want
+
+
+def weekly(flight: Flight, days: str, arrive: str = "") -> Flight:
+    """Copy of `flight` restricted to `days`, optionally with a '+D' arrival."""
+    changes = {"days": parse_days(days)}
+    if arrive:
+        changes["arrive"] = parse_day_offset_time(arrive)
+    return replace(flight, **changes)
+
+
+def test_next_departure_wraps_to_next_operating_day():
+    # Operates Wednesdays (3) only, at 10:00.
+    fl = weekly(f("A", "B", "W1", "10:00", "12:00", 1, 1, 1), "3")
+    monday = 0
+    assert next_departure(fl, monday, parse_time("09:00")) == 2 * 1440 + 600
+    # Ready on Wednesday after 10:00 -> next Wednesday.
+    assert next_departure(fl, monday, 2 * 1440 + 601) == 9 * 1440 + 600
+    # Ready on Wednesday morning -> same day.
+    assert next_departure(fl, 2, 500) == 600
+
+
+def test_periodic_earliest_spans_days_and_overnight():
+    flights = [
+        # Overnight A->B, Mondays only.
+        weekly(f("A", "B", "N1", "23:00", "06:00", 500, 900, 1500), "1", arrive="06:00+1"),
+        # B->C runs Wednesdays only, so the trip waits a day at B.
+        weekly(f("B", "C", "W3", "09:00", "11:00", 200, 400, 600), "3"),
+    ]
+    cg = compile_graph(build_graph(flights))
+    monday = 0
+
+    itin = find_earliest_itinerary_periodic(cg, "A", "C", monday, parse_time("20:00"))
+    assert [fl.flight_number for fl in itin.flights] == ["N1", "W3"]
+    assert itin.depart_time == parse_time("23:00")
+    assert itin.arrive_time == 2 * 1440 + parse_time("11:00")
+    assert_valid_itinerary_times(itin)
+
+    # From Tuesday the Monday-only first leg is a week away.
+    later = find_earliest_itinerary_periodic(cg, "A", "C", 1, 0)
+    assert later.depart_time == 6 * 1440 + parse_time("23:00")
+
+    # The single-day graph memory is unchanged: one edge per scheduled flight.
+    assert cg.num_flights == len(flights)
+
+
+def test_periodic_cheapest_can_wait_for_cheaper_day():
+    flights = [
+        weekly(f("A", "B", "Dear", "08:00", "10:00", 900, 900, 900), "1"),
+        weekly(f("A", "B", "Cheap", "08:00", "10:00", 100, 100, 100), "2"),
+    ]
+    cg = compile_graph(build_graph(flights))
+    cheap = find_cheapest_itinerary_periodic(cg, "A", "B", 0, 0, "economy")
+    fast = find_earliest_itinerary_periodic(cg, "A", "B", 0, 0)
+    assert cheap.flights[0].flight_number == "Cheap"
+    assert cheap.depart_time == 1440 + parse_time("08:00")
+    assert fast.flights[0].flight_number == "Dear"
+    assert find_cheapest_itinerary_periodic(cg, "B", "A", 0, 0, "economy") is None
+
+
+def test_compact_flights_merges_codeshares_and_drops_dominated():
+    flights = [
+        f("A", "B", "FW1", "08:00", "10:00", 300, 900, 1500),
+        f("A", "B", "KE1", "08:00", "10:00", 250, 950, 1500),  # codeshare of FW1
+        # Departs earlier, arrives later, costs more everywhere: dominated.
+        f("A", "B", "SLOW", "07:30", "10:30", 300, 950, 1600),
+        # Earlier but cheaper in economy: not dominated.
+        f("A", "B", "EARLY", "06:00", "09:00", 100, 2000, 3000),
+        # Different days: the daily FW1/KE1 covers Mondays too.
+        weekly(f("A", "B", "MON", "07:00", "11:00", 400, 1000, 1600), "1"),
+        f("B", "C", "F3", "11:00", "12:00", 100, 200, 300),
+    ]
+    compacted, stats = compact_flights(flights)
+
+    numbers = {fl.flight_number for fl in compacted}
+    assert numbers == {"FW1/KE1", "EARLY", "F3"}
+    merged = next(fl for fl in compacted if fl.flight_number == "FW1/KE1")
+    assert (merged.economy, merged.business, merged.first) == (250, 900, 1500)
+    assert stats.flights_in == 6
+    assert stats.codeshares_merged == 1
+    assert stats.dominated_removed == 2
+    assert stats.flights_out == len(compacted) == 3
+    assert "6 -> 3" in stats.summary()
+
+
+def test_compact_flights_keeps_search_results():
+    flights = [
+        f("A", "X", "F1", "08:00", "09:00", 150, 400, 800),
+        f("A", "X", "F1b", "07:00", "09:30", 200, 450, 850),
+        f("X", "B", "F2", "10:30", "11:30", 150, 400, 800),
+        f("A", "B", "F3", "08:00", "12:00", 400, 500, 900),
+        f("A", "B", "F3cs", "08:00", "12:00", 390, 600, 900),
+    ]
+    before = build_graph(flights)
+    after = build_graph(compact_flights(flights)[0])
+    for dep in ("06:00", "07:30", "08:00"):
+        t = parse_time(dep)
+        x = find_earliest_itinerary(before, "A", "B", t)
+        y = find_earliest_itinerary(after, "A", "B", t)
+        assert (x and x.arrive_time) == (y and y.arrive_time)
+        for cabin in ("economy", "business", "first"):
+            x = find_cheapest_itinerary(before, "A", "B", t, cabin)
+            y = find_cheapest_itinerary(after, "A", "B", t, cabin)
+            assert (x and x.total_price(cabin)) == (y and y.total_price(cabin))
+
+
+def test_shared_graph_attach_is_equivalent():
+    flights = [
+        f("A", "X", "FX1", "08:00", "09:00", 150, 400, 800),
+        f("X", "B", "FX2", "10:30", "11:30", 150, 400, 800),
+        weekly(f("A", "B", "FD1", "09:30", "11:30", 400, 500, 900), "135"),
+    ]
+    cg = compile_graph(build_graph(flights))
+    with SharedGraph.publish(cg) as shared:
+        worker = SharedGraph.attach(shared.name)
+        try:
+            g = worker.graph
+            assert g.codes == cg.codes
+            assert list(g.offsets) == cg.offsets
+            assert list(g.flights) == cg.flights
+            for cabin in (None, "economy", "business"):
+                query = ("A", "B", parse_time("07:00"), cabin)
+                assert run_query(g, query) == run_query(cg, query)
+        finally:
+            worker.close()
+
+
+def test_shared_graph_rejects_bad_blocks_without_leaking_views():
+    shm = shared_memory.SharedMemory(create=True, size=64)
+    try:
+        with pytest.raises(ValueError, match="not a FlyWise graph"):
+            SharedGraph.attach(shm.name)
+        struct.pack_into("5q", shm.buf, 0, SHARED_GRAPH_MAGIC, 10, 1000, 0, 0)
+        with pytest.raises(ValueError, match="truncated"):
+            SharedGraph.attach(shm.name)
+        shm.close()  # BufferError if a memoryview had been left exported
+    finally:
+        shm.unlink()
+
+
+def test_parallel_search_matches_serial():
+    flights = [
+        f("A", "X", "FX1", "08:00", "09:00", 150, 400, 800),
+        f("X", "B", "FX2", "10:30", "11:30", 150, 400, 800),
+        f("A", "B", "FD1", "09:30", "11:30", 400, 500, 900),
+    ]
+    cg = compile_graph(build_graph(flights))
+    queries = [
+        (o, d, parse_time("07:00"), cabin)
+        for o in ("A", "X")
+        for d in ("B", "X")
+        for cabin in (None, "economy", "business", "first")
+    ]
+    assert parallel_search(cg, queries, processes=2) == [run_query(cg, q) for q in queries]
+
+
+def test_compute_matrix_matches_point_queries():
+    flights = [
+        f("A", "X", "FX1", "08:00", "09:00", 150, 400, 800),
+        f("X", "B", "FX2", "10:30", "11:30", 150, 400, 800),
+        f("A", "B", "FD1", "09:30", "11:30", 400, 500, 900),
+        f("B", "A", "FR1", "13:00", "15:00", 300, 600, 900),
+    ]
+    cg = compile_graph(build_graph(flights))
+    departures = [parse_time("07:00"), parse_time("09:00")]
+    rows = list(compute_matrix(cg, departures, processes=1))
+
+    # Every ordered pair (except origin == dest) for each origin with departures.
+    assert len(rows) == 3 * 2 * 2
+    for origin, dep, dest, arrival, *fares in rows:
+        itin = find_earliest_itinerary_compiled(cg, origin, dest, dep)
+        assert arrival == (itin.arrive_time if itin else None)
+        for cabin, fare in zip(("economy", "business", "first"), fares):
+            itin = find_cheapest_itinerary_compiled(cg, origin, dest, dep, cabin)
+            assert fare == (itin.total_price(cabin) if itin else None)
+
+    assert list(compute_matrix(cg, departures, ["A"], processes=2)) == [
+        row for row in rows if row[0] == "A"
+    ]
+    with pytest.raises(ValueError):
+        list(compute_matrix(cg, departures, ["Q"], processes=1))
+
+
+def test_earliest_arrivals_multi_matches_per_source_search():
+    flights = [
+        f("A", "B", "F1", "08:00", "09:00", 1, 1, 1),
+        f("B", "C", "F2", "09:59", "11:00", 1, 1, 1),  # misses the layover from F1
+        f("B", "C", "F3", "10:00", "12:00", 1, 1, 1),
+        f("C", "A", "F4", "13:00", "14:00", 1, 1, 1),
+        f("A", "C", "F5", "09:00", "13:30", 1, 1, 1),
+        Flight("C", "D", "F6", parse_time("23:00"), parse_time("06:00") + 1440, 1, 1, 1),
+    ]
+    cg = compile_graph(build_graph(flights))
+    sources = [cg.ids[c] for c in ("A", "B", "C")]
+    for dep in (parse_time("07:00"), parse_time("09:00"), parse_time("10:00")):
+        arrivals = earliest_arrivals_multi(cg, sources, dep)
+        for i, origin in enumerate(("A", "B", "C")):
+            for dest in cg.codes:
+                expected = dep if dest == origin else None
+                if dest != origin:
+                    itin = find_earliest_itinerary_compiled(cg, origin, dest, dep)
+                    expected = itin.arrive_time if itin else None
+                got = arrivals[i][cg.ids[dest]]
+                assert (None if got >= 2**62 else got) == expected, (origin, dest, dep)
+
+    rows = list(compute_matrix(cg, [parse_time("07:00")], cabins=()))
+    assert ("A", parse_time("07:00"), "C", parse_time("12:00"), None, None, None) in rows
+
+
+def test_reachability_index_latest_departures():
+    flights = [
+        f("A", "X", "FX1", "08:00", "09:00", 150, 400, 800),
+        f("X", "B", "FX2", "10:30", "11:30", 150, 400, 800),
+        # Too short a layover after FX3 to make FX2, so FX3 is no use for B.
+        f("A", "X", "FX3", "10:00", "10:00", 100, 100, 100),
+        f("A", "B", "FD1", "07:00", "09:00", 400, 500, 900),
+        f("B", "C", "FC1", "12:00", "13:00", 100, 200, 300),
+    ]
+    cg = compile_graph(build_graph(flights))
+    reach = ReachabilityIndex(cg, precompute=True)
+
+    assert reach.latest_departure("A", "B") == parse_time("08:00")
+    assert reach.latest_departure("X", "B") == parse_time("10:30")
+    # Via FX2 (arrives 11:30) the 12:00 FC1 is too tight; only FD1 works.
+    assert reach.latest_departure("A", "C") == parse_time("07:00")
+    assert reach.latest_departure("B", "A") is None
+    assert reach.can_reach("A", "B", parse_time("08:00"))
+    assert not reach.can_reach("A", "B", parse_time("08:01"))
+
+
+def test_reachability_index_answers_and_prunes_without_changing_results():
+    flights = [
+        f("A", "X", "FX1", "08:00", "09:00", 150, 400, 800),
+        f("X", "B", "FX2", "10:30", "11:30", 150, 400, 800),
+        f("A", "Y", "FY1", "08:00", "09:00", 10, 10, 10),  # cheap dead end
+        f("Y", "Z", "FY2", "10:00", "11:00", 10, 10, 10),
+        f("A", "B", "FD1", "09:30", "11:30", 400, 500, 900),
+    ]
+    cg = compile_graph(build_graph(flights))
+    reach = ReachabilityIndex(cg)
+    for dep in ("07:00", "08:30", "09:30", "10:00"):
+        t = parse_time(dep)
+        assert find_earliest_itinerary_compiled(cg, "A", "B", t, reach) == \
+            find_earliest_itinerary_compiled(cg, "A", "B", t)
+        for cabin in ("economy", "business", "first"):
+            assert find_cheapest_itinerary_compiled(cg, "A", "B", t, cabin, reach) == \
+                find_cheapest_itinerary_compiled(cg, "A", "B", t, cabin)
+    assert find_cheapest_itinerary_compiled(cg, "A", "B", parse_time("10:00"), "economy", reach) is None
+
+
+def test_latest_departure_itinerary_arrive_by():
+    flights = [
+        f("A", "X", "FX1", "08:00", "09:00", 150, 400, 800),
+        f("X", "B", "FX2", "10:30", "11:30", 150, 400, 800),
+        f("A", "X", "FX3", "09:45", "10:15", 150, 400, 800),  # too tight for FX2
+        f("A", "B", "FD1", "07:00", "09:00", 400, 500, 900),
+        f("A", "B", "FD2", "11:00", "13:00", 400, 500, 900),
+    ]
+    reverse = build_reverse_graph(flights)
+    assert {fl.flight_number for fl in reverse["B"]} == {"FX2", "FD1", "FD2"}
+
+    itin = find_latest_departure_itinerary(reverse, "A", "B", parse_time("12:00"))
+    assert [fl.flight_number for fl in itin.flights] == ["FX1", "FX2"]
+    assert_valid_itinerary_times(itin)
+
+    late = find_latest_departure_itinerary(reverse, "A", "B", parse_time("13:00"))
+    assert [fl.flight_number for fl in late.flights] == ["FD2"]
+
+    # earliest_departure cuts off FD1 and FX1.
+    assert find_latest_departure_itinerary(
+        reverse, "A", "B", parse_time("12:00"), earliest_departure=parse_time("08:30")
+    ) is None
+    assert find_latest_departure_itinerary(reverse, "A", "B", parse_time("08:59")) is None
+
+    cg = compile_graph(build_graph(flights))
+    for arrive_by in ("09:00", "12:00", "13:00", "23:00"):
+        t = parse_time(arrive_by)
+        assert find_latest_departure_itinerary_compiled(cg, "A", "B", t) == \
+            find_latest_departure_itinerary(reverse, "A", "B", t)
+
+
+def test_arrive_by_bounds_restrict_cheapest():
+    flights = [
+        f("A", "B", "SLOWCHEAP", "08:00", "20:00", 100, 100, 100),
+        f("A", "B", "FASTDEAR", "08:00", "12:00", 500, 500, 500),
+    ]
+    cg = compile_graph(build_graph(flights))
+    reach = ReachabilityIndex(cg, arrive_by=parse_time("15:00"))
+    itin = find_cheapest_itinerary_compiled(cg, "A", "B", parse_time("07:00"), "economy", reach)
+    assert itin.flights[0].flight_number == "FASTDEAR"
+    assert find_cheapest_itinerary_compiled(cg, "A", "B", parse_time("07:00"), "economy").flights[0].flight_number == "SLOWCHEAP"
+
+
+def test_multi_airport_search_matches_best_pair():
+    flights = [
+        f("ICN", "SFO", "F1", "09:00", "19:00", 900, 1500, 2500),
+        f("GMP", "OAK", "F2", "08:00", "17:00", 700, 1600, 2600),
+        f("ICN", "SJC", "F3", "10:00", "18:30", 800, 1400, 2400),
+        f("GMP", "ICN", "F4", "06:00", "07:00", 50, 50, 50),
+    ]
+    cg = compile_graph(build_graph(flights))
+    reach = ReachabilityIndex(cg)
+    origins = expand_airport_code("SEL")
+    dests = expand_airport_code("BAY")
+    assert origins == ("ICN", "GMP") and expand_airport_code("ICN") == ("ICN",)
+
+    earliest = find_earliest_itinerary_multi(cg, origins, dests, parse_time("05:00"), reach)
+    assert [fl.flight_number for fl in earliest.flights] == ["F2"]
+    cheapest = find_cheapest_itinerary_multi(cg, origins, dests, parse_time("05:00"), "business", reach)
+    assert [fl.flight_number for fl in cheapest.flights] == ["F3"]
+    economy = find_cheapest_itinerary_multi(cg, origins, dests, parse_time("05:00"), "economy")
+    assert [fl.flight_number for fl in economy.flights] == ["F2"]
+    assert find_earliest_itinerary_multi(cg, origins, dests, parse_time("10:30")) is None
+    assert find_earliest_itinerary_multi(cg, ["ICN"], ["ICN", "SFO"], 0) is None
+
+
+def test_round_trip_joint_return_constraint():
+    flights = [
+        f("A", "B", "Fcheap", "12:00", "17:00", 100, 500, 900),
+        f("A", "B", "Fearly", "08:00", "10:00", 300, 400, 800),
+        f("B", "A", "Rmorning", "11:00", "13:00", 100, 300, 500),
+        f("B", "A", "Rlate", "18:30", "20:30", 400, 600, 700),
+    ]
+    cg = compile_graph(build_graph(flights))
+    trips = {t.mode: t for t in find_round_trips(cg, "A", "B", parse_time("07:00"), parse_time("09:00"))}
+
+    # Same-day return: the cheap outbound lands too late for the cheap
+    # return, and 300 + 100 beats 100 + 400.
+    economy = trips["Cheapest (Economy)"]
+    assert [fl.flight_number for fl in economy.outbound.flights] == ["Fearly"]
+    assert [fl.flight_number for fl in economy.inbound.flights] == ["Rmorning"]
+    assert economy.total_price() == 400
+    assert trips["Fastest"].inbound.arrive_time == parse_time("13:00")
+    assert trips["Cheapest (First)"].total_price() == 1300
+
+    # Returning the next day decouples the legs; times move onto day +1.
+    later = {t.mode: t for t in find_round_trips(cg, "A", "B", parse_time("07:00"), 1440 + parse_time("09:00"))}
+    economy = later["Cheapest (Economy)"]
+    assert economy.total_price() == 200
+    assert economy.inbound.depart_time == 1440 + parse_time("11:00")
+
+    none = find_round_trips(cg, "A", "B", parse_time("07:00"), parse_time("19:00"))
+    assert all(t.outbound is None and t.total_price() is None for t in none)
+
+
+def test_build_graph_collects_stats_for_engine_choice():
+    flights = [
+        f("A", "B", "F1", "08:00", "09:00", 100, 200, 300),
+        f("A", "C", "F2", "10:00", "11:00", 100, 200, 300),
+        f("B", "C", "F3", "10:00", "11:00", 100, 200, 300),
+    ]
+    stats = GraphStats()
+    graph = build_graph(flights, stats)
+    assert (stats.flights, stats.airports, stats.origins, stats.max_out_degree) == (3, 3, 2, 2)
+    assert GraphStats.from_compiled(compile_graph(graph)) == stats
+
+    # One-shot query on a dict graph: compiling is not worth it.
+    engine, reason = choose_engine(SearchContext(graph, stats=stats), 1, 3)
+    assert engine.name == "dijkstra" and "3 flights" in reason
+    # Once a compiled graph exists, a compiled engine is cheaper.
+    ctx = SearchContext(cg=compile_graph(graph))
+    assert choose_engine(ctx, 1, 3)[0].name in ("compiled", "reach")
+    assert "dijkstra n/a" in choose_engine(ctx, 1, 3)[1]
+    # Only the reach engine enforces an arrival deadline.
+    assert choose_engine(SearchContext(graph, arrive_by=parse_time("12:00")), 1, 3)[0].name == "reach"
+
+    for engine in ENGINES.values():
+        ctx = SearchContext(graph)
+        assert engine.cheapest(ctx, "A", "C", 0, "economy") == find_cheapest_itinerary(graph, "A", "C", 0, "economy")
+
+
+def test_schedule_store_versions_share_unchanged_airports():
+    f1 = f("A", "B", "F1", "08:00", "09:00", 100, 200, 300)
+    f2 = f("B", "C", "F2", "10:00", "11:00", 100, 200, 300)
+    f3 = f("A", "C", "F3", "12:00", "13:00", 50, 60, 70)
+    store = ScheduleStore([f1, f2])
+
+    with store.pin() as v0:
+        v1 = store.update(add=[f3])
+        # The pinned version is untouched; the new one shares B's tuple.
+        assert v0.version == 0 and list(v0["A"]) == [f1]
+        assert v1["B"] is v0["B"] and list(v1["A"]) == [f1, f3]
+        assert find_cheapest_itinerary(v0, "A", "C", 0, "economy").total_price("economy") == 200
+        assert find_cheapest_itinerary(v1, "A", "C", 0, "economy").total_price("economy") == 50
+        assert find_earliest_itinerary_compiled(v1.compiled(), "A", "C", 0).arrive_time == parse_time("11:00")
+
+    v2 = store.refresh([f1, f2])
+    assert v2["B"] is v1["B"] and list(v2["A"]) == [f1]
+    with pytest.raises(ValueError):
+        store.update(remove=[f3, f3])
+
+    assert store.live_versions() == [0, 1, 2]
+    del v0, v1
+    assert store.live_versions() == [2]
+    assert store.current() is v2
+
+
+def test_earliest_within_budget_trades_time_for_price():
+    flights = [
+        f("A", "B", "Fast", "08:00", "10:00", 900, 1200, 2000),
+        f("A", "X", "Fax", "08:00", "09:00", 200, 300, 400),
+        f("X", "B", "Fxb_early", "10:00", "12:00", 500, 600, 700),
+        f("X", "B", "Fxb_late", "14:00", "16:00", 100, 200, 300),
+    ]
+    cg = compile_graph(build_graph(flights))
+    reach = ReachabilityIndex(cg)
+    dep = parse_time("07:00")
+
+    def numbers(max_price):
+        itin = find_earliest_itinerary_within_budget(cg, "A", "B", dep, "economy", max_price, reach)
+        return [fl.flight_number for fl in itin.flights] if itin else None
+
+    assert numbers(1000) == ["Fast"]
+    assert numbers(899) == ["Fax", "Fxb_early"]  # 700, arrives 12:00
+    assert numbers(699) == ["Fax", "Fxb_late"]  # 300, arrives 16:00
+    assert numbers(299) is None
+    assert fare_lower_bounds(cg, cg.ids["B"], "economy")[cg.ids["A"]] == 300
+
+
+def test_anytime_search_returns_incumbent_with_gap_at_deadline(monkeypatch):
+    flights = [
+        f("A", "B", "Fab", "08:00", "09:00", 100, 100, 100),
+        f("B", "D", "Fbd_missed", "09:30", "11:00", 100, 100, 100),
+        f("B", "D", "Fbd", "12:00", "13:00", 400, 400, 400),
+        f("A", "C", "Fac", "08:00", "09:00", 150, 150, 150),
+        f("C", "D", "Fcd", "11:00", "12:00", 150, 150, 150),
+    ]
+    cg = compile_graph(build_graph(flights))
+    reach = ReachabilityIndex(cg)
+    dep = parse_time("07:00")
+
+    full = find_cheapest_itinerary_anytime(cg, "A", "D", dep, "economy", 10_000, reach)
+    assert full.complete and full.gap == 0
+    assert [fl.flight_number for fl in full.itinerary.flights] == ["Fac", "Fcd"]
+    earliest = find_earliest_itinerary_anytime(cg, "A", "D", dep, 10_000, reach)
+    assert earliest.complete
+    assert earliest.itinerary.arrive_time == find_earliest_itinerary_compiled(cg, "A", "D", dep).arrive_time
+
+    # Out of time after one pop: the greedy completion (cheapest first leg,
+    # then the only catchable connection) is returned with a proven gap.
+    monkeypatch.setattr(flight_planner, "DEADLINE_CHECK_INTERVAL", 1)
+    cut = find_cheapest_itinerary_anytime(cg, "A", "D", dep, "economy", 0, reach)
+    assert not cut.complete
+    assert [fl.flight_number for fl in cut.itinerary.flights] == ["Fab", "Fbd"]
+    assert cut.gap == 300
+    assert cut.itinerary.total_price("economy") - cut.gap <= full.itinerary.total_price("economy")
+    assert cut.note("in price") == "(deadline hit, within 300 in price of optimal)"
+    assert find_earliest_itinerary_anytime(cg, "A", "D", dep, 0, reach).complete is False
+
+
+def test_epsilon_cheapest_stays_within_factor_of_optimum():
+    flights = [
+        f("A", "D", "Direct", "08:00", "12:00", 105, 105, 105),
+        f("A", "B", "Fab", "08:00", "09:00", 96, 96, 96),
+        f("B", "D", "Fbd", "10:00", "11:00", 4, 4, 4),
+    ]
+    graph = build_graph(flights)
+    cg = compile_graph(graph)
+    reach = ReachabilityIndex(cg)
+    dep = parse_time("07:00")
+
+    assert find_cheapest_itinerary(graph, "A", "D", dep, "economy").total_price("economy") == 100
+    # The direct flight is an incumbent as soon as it is relaxed; the
+    # 96-cost label at B is within 10% of it, so the search stops there.
+    approx = find_cheapest_itinerary(graph, "A", "D", dep, "economy", epsilon=0.1)
+    assert [fl.flight_number for fl in approx.flights] == ["Direct"]
+    assert find_cheapest_itinerary(graph, "A", "D", dep, "economy", epsilon=0.01).total_price("economy") == 100
+
+    for r in (None, reach):
+        itin = find_cheapest_itinerary_compiled(cg, "A", "D", dep, "economy", r, epsilon=0.1)
+        assert itin.total_price("economy") <= 110
+    assert find_cheapest_itinerary_compiled(cg, "A", "A", dep, "economy", reach, epsilon=0.1) == Itinerary(flights=[])
+
+
+def test_search_filter_matches_searching_a_prefiltered_graph():
+    flights = [
+        f("A", "B", "XX10", "06:00", "07:00", 50, 50, 50),
+        f("B", "D", "XX11", "08:00", "09:00", 50, 50, 50),
+        f("A", "C", "YY20/XX20", "06:30", "07:30", 80, 80, 80),
+        f("C", "D", "YY21", "23:00", "23:50", 40, 40, 40),
+        f("C", "D", "ZZ30", "10:00", "12:00", 90, 90, 90),
+        f("A", "D", "ZZ31", "05:00", "13:00", 300, 300, 300),
+    ]
+    graph = build_graph(flights)
+    cg = compile_graph(graph)
+    reach = ReachabilityIndex(cg)
+    dep = parse_time("04:00")
+
+    def numbers(itin):
+        return [fl.flight_number for fl in itin.flights] if itin else None
+
+    cases = [
+        SearchFilter(avoid_airports=frozenset({"B"})),
+        SearchFilter(avoid_carriers=frozenset({"XX"})),
+        SearchFilter(avoid_carriers=frozenset({"XX", "YY"})),
+        SearchFilter(no_red_eye=True),
+        SearchFilter(avoid_airports=frozenset({"B", "C", "D"}), no_red_eye=True),
+    ]
+    for flt in cases:
+        kept = build_graph(fl for fl in flights if flt.allows(fl, "D"))
+        edge = flt.compile(cg)
+        want_e = numbers(find_earliest_itinerary(kept, "A", "D", dep))
+        want_c = numbers(find_cheapest_itinerary(kept, "A", "D", dep, "economy"))
+        assert numbers(find_earliest_itinerary(graph, "A", "D", dep, flt)) == want_e
+        assert numbers(find_cheapest_itinerary(graph, "A", "D", dep, "economy", flt=flt)) == want_c
+        for r in (None, reach):
+            assert numbers(find_earliest_itinerary_compiled(cg, "A", "D", dep, r, edge)) == want_e
+            assert numbers(find_cheapest_itinerary_compiled(cg, "A", "D", dep, "economy", r, flt=edge)) == want_c
+
+    assert FlightTags.of(cg) is FlightTags.of(cg)
+    # The codeshare survives avoiding XX because YY20 still operates it.
+    only_yy = SearchFilter(avoid_carriers=frozenset({"XX"})).compile(cg)
+    assert numbers(find_cheapest_itinerary_compiled(cg, "A", "D", dep, "economy", flt=only_yy)) == ["YY20/XX20", "YY21"]
+
+
+def test_radix_heap_pops_in_key_order_and_stays_monotone():
+    pq = RadixHeap(100)
+    for key, item in [(130, "c"), (100, "a"), (4_000_000_000, "e"), (4000, "d"), (130, "b")]:
+        pq.push(key, item)
+    popped = [(pq.pop(), pq.key)]
+    pq.push(101, "a2")  # at or above the last popped key is fine
+    while pq:
+        popped.append((pq.pop(), pq.key))
+    assert popped == [("a", 100), ("a2", 101), ("b", 130), ("c", 130), ("d", 4000), ("e", 4_000_000_000)]
+    with pytest.raises(ValueError):
+        pq.push(3999, "late")
+    with pytest.raises(IndexError):
+        pq.pop()
+
+
+def test_dial_queue_pops_in_key_order_within_its_window():
+    pq = DialQueue(1400, span=100)
+    for key, item in [(1430, "c"), (1400, "a"), (1499, "e"), (1450, "d"), (1430, "b")]:
+        pq.push(key, item)
+    popped = [(pq.pop(), pq.key)]
+    pq.push(1401, "a2")
+    while pq:
+        popped.append((pq.pop(), pq.key))
+    # The window wraps round the bucket array (1450 % 100 < 1430 % 100).
+    assert popped == [("a", 1400), ("a2", 1401), ("b", 1430), ("c", 1430), ("d", 1450), ("e", 1499)]
+    pq.push(1598, "f")  # the window moved up with the last popped key
+    assert pq.pop() == "f" and pq.key == 1598
+    with pytest.raises(ValueError):
+        pq.push(1597, "late")
+    with pytest.raises(ValueError):
+        pq.push(1698, "beyond the window")
+    with pytest.raises(IndexError):
+        pq.pop()
+
+
+def test_searches_agree_across_priority_queues():
+    flights = [
+        f("A", "B", "F1", "08:00", "09:00", 100, 100, 100),
+        f("B", "D", "F2", "12:00", "13:00", 100, 100, 100),
+        f("A", "C", "F3", "08:30", "09:30", 150, 150, 150),
+        f("C", "D", "F4", "10:30", "11:30", 50, 50, 50),
+        f("A", "D", "F5", "07:00", "14:00", 200, 200, 200),
+    ]
+    graph = build_graph(flights)
+    dep = parse_time("06:00")
+    for pqueue in PRIORITY_QUEUES:
+        earliest = find_earliest_itinerary(graph, "A", "D", dep, pqueue=pqueue)
+        assert [fl.flight_number for fl in earliest.flights] == ["F3", "F4"]
+        if pqueue == "dial":
+            with pytest.raises(ValueError, match="minute keys"):
+                find_cheapest_itinerary(graph, "A", "D", dep, "economy", pqueue=pqueue)
+            continue
+        # Three routes cost 200; the one arriving first wins whatever the
+        # order equal keys pop in.
+        cheapest = find_cheapest_itinerary(graph, "A", "D", dep, "economy", pqueue=pqueue)
+        assert cheapest.total_price("economy") == 200
+        assert cheapest.arrive_time == parse_time("11:30")
+
+
+def test_background_indexer_serves_with_dijkstra_then_switches(monkeypatch):
+    flights = [
+        f("A", "B", "F1", "08:00", "09:00", 100, 200, 300),
+        f("B", "C", "F2", "10:30", "12:00", 100, 200, 300),
+        f("A", "C", "F3", "09:00", "13:00", 150, 250, 350),
+    ]
+    dep = parse_time("07:00")
+
+    ctx = SearchContext(build_graph(flights))
+    indexer = BackgroundIndexer(ctx)
+    assert indexer.target.name == "reach"
+    assert indexer.engine().name == "dijkstra"
+    status = indexer.status()
+    assert not status["ready"]
+    assert {name: stage["state"] for name, stage in status["stages"].items()} == {
+        "compiled": "pending", "reach": "pending",
+    }
+    before = indexer.engine().cheapest(ctx, "A", "C", dep, "economy")
+
+    assert indexer.start().wait(10)
+    status = indexer.status()
+    assert status["ready"] and status["engine"] == "reach" and status["error"] is None
+    assert status["bounds"] == {"done": 3, "total": 3}
+    assert ctx.reach_index.misses == 0
+    after = indexer.engine().cheapest(ctx, "A", "C", dep, "economy")
+    assert [fl.flight_number for fl in after.flights] == [fl.flight_number for fl in before.flights]
+
+    # A failed build is reported and leaves queries on the last good engine.
+    def broken(graph):
+        raise MemoryError("out of memory")
+
+    monkeypatch.setattr(flight_planner, "compile_graph", broken)
+    failing = BackgroundIndexer(SearchContext(build_graph(flights))).start()
+    assert failing.wait(10)
+    status = failing.status()
+    assert status["engine"] == "dijkstra" and not status["ready"]
+    assert status["stages"]["compiled"]["state"] == "failed"
+    assert status["error"] == "MemoryError: out of memory"
@@ -2,14 +2,19 @@
 
 from __future__ import annotations
 
+import csv
+import io
+import json
 import textwrap
 from pathlib import Path
 
 import pytest
 
+import flight_planner
 from flight_planner import (
     Flight,
     Itinerary,
+    ItineraryPath,
     ComparisonRow,
     format_comparison_table,
     parse_time,
@@ -21,6 +26,10 @@ from flight_planner import (
     load_flights_txt,
     build_arg_parser,
     main,
+    load_flights,
+    write_indexed_schedule,
+    write_comparison,
+    read_matrix_binary,
 )
 
 
@@ -67,6 +76,24 @@ def test_itinerary_properties_and_price_and_stops():
     assert first_total == 1500 + 2000
 
 
+def test_itinerary_path_shares_prefix_and_caches_totals():
+    f1, f2 = make_demo_itinerary().flights
+    f3 = Flight("NRT", "LAX", "F3", parse_time("12:00"), parse_time("20:00"), 450, 1100, 1900)
+    head = ItineraryPath(f1)
+    to_sfo = head.extend(f2)
+    to_lax = head.extend(f3)
+
+    assert to_sfo.prev is head and to_lax.prev is head
+    assert head.to_flights() == [f1]
+    assert to_sfo.to_itinerary() == make_demo_itinerary()
+    assert (to_lax.origin, to_lax.dest) == ("ICN", "LAX")
+    assert to_lax.depart_time == parse_time("08:00")
+    assert to_lax.arrive_time == parse_time("20:00")
+    assert to_lax.num_stops() == 1
+    for cabin in ("economy", "business", "first"):
+        assert to_sfo.total_price(cabin) == make_demo_itinerary().total_price(cabin)
+
+
 def test_format_comparison_table_basic():
     itin = make_demo_itinerary()
     rows = [
@@ -146,3 +173,380 @@ def test_end_to_end_small_cli(tmp_path: Path, capsys):
     assert "SFO" in captured
     # We expect at least one of the mode labels
     assert "Cheapest" in captured or "Earliest" in captured
+
+
+def test_cli_index_then_compare_uses_indexed_schedule(tmp_path: Path, capsys):
+    content = textwrap.dedent(
+        """
+        ICN NRT FW101 08:00 10:00 300 800 1500
+        NRT SFO FW102 11:30 19:30 500 1200 2000
+        ICN SFO FW103 09:00 19:00 700 1500 2500
+        """
+    ).strip()
+    src = tmp_path / "tiny_flights.txt"
+    src.write_text(content + "\n", encoding="utf-8")
+    indexed = tmp_path / "tiny_indexed.txt"
+
+    main(["index", str(src), str(indexed)])
+    assert (tmp_path / "tiny_indexed.txt.idx").exists()
+    capsys.readouterr()
+
+    main(["compare", str(src), "ICN", "SFO", "07:00"])
+    plain = capsys.readouterr().out
+    main(["compare", str(indexed), "ICN", "SFO", "07:00"])
+    lazy = capsys.readouterr().out
+
+    assert "Cheapest (Economy)" in lazy
+    assert lazy == plain
+
+
+def demo_rows() -> list:
+    return [
+        ComparisonRow(mode="Earliest arrival", cabin=None, itinerary=make_demo_itinerary()),
+        ComparisonRow(mode="Cheapest (First)", cabin="first", itinerary=make_demo_itinerary()),
+        ComparisonRow(mode="Cheapest (Economy)", cabin="economy", itinerary=None),
+    ]
+
+
+def test_write_comparison_json_and_ndjson():
+    buf = io.StringIO()
+    write_comparison(buf, "json", "ICN", "SFO", parse_time("07:00"), demo_rows())
+    doc = json.loads(buf.getvalue())
+    assert doc["earliest_departure"] == "07:00"
+    assert doc["min_layover_minutes"] == MIN_LAYOVER_MINUTES
+    earliest, first, missing = doc["rows"]
+    assert earliest["found"] is True
+    assert earliest["cabin"] is None
+    assert earliest["total_price"] == 300 + 500  # economy fares
+    assert earliest["depart"] == "08:00" and earliest["arrive"] == "19:30"
+    assert earliest["duration_minutes"] == 11 * 60 + 30
+    assert earliest["stops"] == 1
+    assert [leg["flight_number"] for leg in earliest["flights"]] == ["F1", "F2"]
+    assert first["total_price"] == 1500 + 2000
+    assert [leg["price"] for leg in first["flights"]] == [1500, 2000]
+    assert missing["found"] is False and missing["note"] == "(no valid itinerary)"
+
+    buf = io.StringIO()
+    write_comparison(buf, "ndjson", "ICN", "SFO", parse_time("07:00"), demo_rows())
+    lines = buf.getvalue().splitlines()
+    assert len(lines) == 3
+    assert [json.loads(line) for line in lines] == doc["rows"]
+
+
+def test_write_comparison_csv():
+    buf = io.StringIO()
+    write_comparison(buf, "csv", "ICN", "SFO", parse_time("07:00"), demo_rows())
+    records = list(csv.DictReader(io.StringIO(buf.getvalue())))
+    assert len(records) == 3
+    assert records[0]["flights"] == "F1|F2"
+    assert records[1]["total_price"] == "3500"
+    assert records[2]["found"] == "false"
+
+
+def test_cli_compare_format_json(tmp_path: Path, capsys):
+    path = tmp_path / "tiny.txt"
+    path.write_text("ICN SFO FW103 09:00 19:00 700 1500 2500\n", encoding="utf-8")
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--format", "json"])
+    doc = json.loads(capsys.readouterr().out)
+    assert [row["mode"] for row in doc["rows"]] == [
+        "Earliest arrival",
+        "Cheapest (Economy)",
+        "Cheapest (Business)",
+        "Cheapest (First)",
+    ]
+    assert doc["rows"][2]["total_price"] == 1500
+
+
+def test_cli_compare_merges_several_files(tmp_path: Path, capsys):
+    first_leg = tmp_path / "fw.txt"
+    first_leg.write_text("ICN NRT FW101 08:00 10:00 300 800 1500\n", encoding="utf-8")
+    second_leg = tmp_path / "ke.txt"
+    second_leg.write_text("NRT SFO KE102 11:30 19:30 500 1200 2000\n", encoding="utf-8")
+
+    main(["compare", str(first_leg), str(second_leg), "ICN", "SFO", "07:00", "--format", "csv"])
+    out = capsys.readouterr().out
+    assert "FW101|KE102" in out
+
+
+def test_cli_matrix_csv_and_binary(tmp_path: Path, capsys):
+    path = tmp_path / "tiny.txt"
+    path.write_text(
+        "ICN NRT FW101 08:00 10:00 300 800 1500\n"
+        "NRT SFO FW102 11:30 19:30 500 1200 2000\n",
+        encoding="utf-8",
+    )
+    main(["matrix", str(path), "--departures", "07:00,09:00", "--processes", "1"])
+    records = list(csv.DictReader(io.StringIO(capsys.readouterr().out)))
+    by_key = {(r["origin"], r["departure"], r["dest"]): r for r in records}
+    assert by_key[("ICN", "07:00", "SFO")]["earliest_arrival"] == "19:30"
+    assert by_key[("ICN", "07:00", "SFO")]["business"] == "2000"
+    assert by_key[("ICN", "09:00", "SFO")]["economy"] == ""
+
+    out = tmp_path / "matrix.bin"
+    main(["matrix", str(path), "--departures", "07:00,09:00", "--format", "bin",
+          "--output", str(out), "--processes", "1"])
+    rows = read_matrix_binary(out.read_bytes())
+    assert len(rows) == len(records)
+    assert ("ICN", parse_time("07:00"), "SFO", parse_time("19:30"), 800, 2000, 3500) in rows
+
+    bad = tmp_path / "bad.csv"
+    main(["matrix", str(path), "--departures", "07:00", "--origins", "ICN,XXX", "--output", str(bad)])
+    assert "Unknown origin airport(s): XXX" in capsys.readouterr().out
+    assert not bad.exists()
+
+
+def test_cli_compare_arrive_by(tmp_path: Path, capsys):
+    path = tmp_path / "tiny.txt"
+    path.write_text(
+        "ICN NRT FW101 08:00 10:00 300 800 1500\n"
+        "NRT SFO FW102 11:30 19:30 500 1200 2000\n"
+        "ICN SFO FW103 12:00 18:00 900 1500 2500\n",
+        encoding="utf-8",
+    )
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--arrive-by", "19:00", "--format", "csv"])
+    records = {r["mode"]: r for r in csv.DictReader(io.StringIO(capsys.readouterr().out))}
+    assert records["Latest departure"]["flights"] == "FW103"
+    # The cheaper connection arrives after 19:00, so it is excluded.
+    assert records["Cheapest (Economy)"]["flights"] == "FW103"
+
+
+def test_cli_compare_max_memory_streams_same_answer(tmp_path: Path, capsys):
+    path = tmp_path / "tiny.txt"
+    path.write_text(
+        "ICN NRT FW101 08:00 10:00 300 800 1500\n"
+        "NRT SFO FW102 11:30 19:30 500 1200 2000\n"
+        "ICN SFO FW103 12:00 18:00 900 1500 2500\n",
+        encoding="utf-8",
+    )
+    main(["compare", str(path), "ICN", "SFO", "07:00"])
+    normal = capsys.readouterr().out
+
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--max-memory", "0.0001"])
+    captured = capsys.readouterr()
+    assert captured.out == normal
+    assert "streaming loader" in captured.err
+    assert "load+build (streaming)" in captured.err
+
+    # Compaction cannot run on the stream: a clear error, not a silent skip.
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--max-memory", "0.0001", "--compact"])
+    assert "Error: --compact" in capsys.readouterr().out
+
+    # Cross-file duplicate flight numbers are still caught while streaming.
+    dup = tmp_path / "dup.txt"
+    dup.write_text("ICN PEK FW101 10:00 11:00 100 200 300\n", encoding="utf-8")
+    main(["compare", str(path), str(dup), "ICN", "SFO", "07:00", "--max-memory", "0.0001"])
+    assert "Duplicate flight number FW101" in capsys.readouterr().out
+
+
+def test_cli_compare_metro_codes(tmp_path: Path, capsys):
+    path = tmp_path / "tiny.txt"
+    path.write_text(
+        "ICN SFO FW101 09:00 19:00 900 1500 2500\n"
+        "GMP OAK FW102 08:00 17:00 700 1600 2600\n",
+        encoding="utf-8",
+    )
+    metros = tmp_path / "metros.txt"
+    metros.write_text("# city airports\nXSL ICN GMP\n", encoding="utf-8")
+    main(["compare", str(path), "XSL", "BAY", "07:00", "--metros", str(metros), "--format", "csv"])
+    records = {r["mode"]: r for r in csv.DictReader(io.StringIO(capsys.readouterr().out))}
+    assert records["Earliest arrival"]["flights"] == "FW102"
+    assert records["Cheapest (Business)"]["flights"] == "FW101"
+
+    main(["compare", str(path), "XSL", "BAY", "07:00", "--metros", str(metros), "--day", "Mon"])
+    assert "cannot be combined" in capsys.readouterr().out
+
+
+def test_cli_compare_airport_code_wins_over_metro(tmp_path: Path, capsys):
+    path = tmp_path / "tiny.txt"
+    path.write_text(
+        "SHA ICN FW201 09:00 12:00 300 800 1500\n"
+        "PVG ICN FW202 07:30 10:30 250 700 1400\n",
+        encoding="utf-8",
+    )
+    # SHA is Hongqiao airport here, not the Shanghai metro area (PVG + SHA).
+    main(["compare", str(path), "SHA", "ICN", "07:00", "--format", "csv", "--day", "Mon"])
+    records = {r["mode"]: r for r in csv.DictReader(io.StringIO(capsys.readouterr().out))}
+    assert records["Earliest arrival"]["flights"] == "FW201"
+    assert records["Cheapest (Economy)"]["flights"] == "FW201"
+
+    # Without a Hongqiao airport in the schedule, SHA is the metro area.
+    path.write_text("PVG ICN FW202 07:30 10:30 250 700 1400\n", encoding="utf-8")
+    main(["compare", str(path), "SHA", "ICN", "07:00", "--format", "csv"])
+    records = {r["mode"]: r for r in csv.DictReader(io.StringIO(capsys.readouterr().out))}
+    assert records["Earliest arrival"]["flights"] == "FW202"
+
+
+def test_cli_roundtrip(tmp_path: Path, capsys):
+    path = tmp_path / "tiny.txt"
+    path.write_text(
+        "ICN NRT FW101 08:00 10:00 300 800 1500\n"
+        "NRT ICN FW102 12:00 14:00 250 700 1400\n",
+        encoding="utf-8",
+    )
+    main(["roundtrip", str(path), "ICN", "NRT", "07:00", "09:00+1"])
+    out = capsys.readouterr().out
+    assert "Round trip ICN ⇄ NRT" in out
+    economy = next(line for line in out.splitlines() if line.startswith("Cheapest (Economy)"))
+    assert "08:00-10:00" in economy and "12:00+1-14:00+1" in economy and "550" in economy
+
+
+def test_cli_compare_engine_choice_is_logged(tmp_path: Path, capsys):
+    path = tmp_path / "tiny.txt"
+    path.write_text(
+        "ICN NRT FW101 08:00 10:00 300 800 1500\n"
+        "NRT SFO FW102 11:30 19:30 500 1200 2000\n",
+        encoding="utf-8",
+    )
+    main(["compare", str(path), "ICN", "SFO", "07:00"])
+    default = capsys.readouterr()
+    assert default.err == ""
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--verbose"])
+    assert capsys.readouterr().err == "Engine: reach (default)\n"
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--engine", "auto"])
+    auto = capsys.readouterr()
+    assert auto.err.startswith("Engine: dijkstra (2 flights")
+    assert auto.out == default.out
+
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--engine", "compiled", "--arrive-by", "20:00"])
+    assert "cannot answer" in capsys.readouterr().out
+
+    # Every engine agrees that start == dest is an empty route; compare says so.
+    for engine in ("dijkstra", "reach"):
+        main(["compare", str(path), "ICN", "ICN", "07:00", "--engine", engine])
+        assert capsys.readouterr().out == "Error: origin and destination must differ\n"
+
+
+def test_cli_compare_default_engine_keeps_indexed_schedule_lazy(tmp_path: Path, capsys, monkeypatch):
+    source = tmp_path / "tiny.txt"
+    source.write_text(
+        "ICN NRT FW101 08:00 10:00 300 800 1500\n"
+        "NRT SFO FW102 11:30 19:30 500 1200 2000\n"
+        # An unrelated part of the network that ICN -> SFO never reaches.
+        "LHR CDG FW201 08:00 09:00 100 200 300\n"
+        "CDG FRA FW202 10:00 11:00 100 200 300\n",
+        encoding="utf-8",
+    )
+    path = tmp_path / "indexed.txt"
+    write_indexed_schedule(load_flights(str(source)), str(path))
+    opened = []
+
+    def spy(p: str):
+        opened.append(flight_planner.LazyGraph(p))
+        return opened[-1]
+
+    monkeypatch.setattr(flight_planner, "load_indexed_graph", spy)
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--verbose"])
+    captured = capsys.readouterr()
+    assert captured.err.startswith("Engine: dijkstra (default for an indexed schedule")
+    assert "19:30" in captured.out
+    lazy = opened[0]
+    assert lazy.loaded_airports() == {"ICN", "NRT"}
+    assert lazy.loaded_airports() < set(lazy)
+
+
+def test_cli_compare_max_price_row(tmp_path: Path, capsys):
+    path = tmp_path / "tiny.txt"
+    path.write_text(
+        "ICN SFO FW100 09:00 19:00 900 1500 2500\n"
+        "ICN NRT FW101 08:00 10:00 300 800 1500\n"
+        "NRT SFO FW102 11:30 19:30 500 1200 2000\n",
+        encoding="utf-8",
+    )
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--max-price", "850", "--format", "csv"])
+    records = {r["mode"]: r for r in csv.DictReader(io.StringIO(capsys.readouterr().out))}
+    assert records["Earliest arrival"]["flights"] == "FW100"
+    assert records["Earliest within 850"]["flights"] == "FW101|FW102"
+    assert records["Earliest within 850"]["total_price"] == "800"
+
+
+def test_cli_loadtest_reports_percentiles_and_cache_hits(tmp_path: Path, capsys):
+    src = tmp_path / "tiny.txt"
+    src.write_text(
+        "ICN NRT FW101 08:00 10:00 300 800 1500\n"
+        "NRT SFO FW102 11:30 19:30 500 1200 2000\n"
+        "ICN SFO FW103 09:00 19:00 700 1500 2500\n",
+        encoding="utf-8",
+    )
+    indexed = tmp_path / "indexed.txt"
+    main(["index", str(src), str(indexed)])
+    queries = tmp_path / "queries.txt"
+    queries.write_text("ICN SFO 07:00\nICN SFO 07:00 economy\nNRT ICN 07:00 first\n", encoding="utf-8")
+    report_path = tmp_path / "report.json"
+    capsys.readouterr()
+
+    main([
+        "loadtest", str(indexed), "--queries", str(queries),
+        "--concurrency", "2", "--engine", "reach", "--output", str(report_path),
+    ])
+    assert "3 queries" in capsys.readouterr().out
+    report = json.loads(report_path.read_text(encoding="utf-8"))
+    assert report["engine"] == "reach"
+    assert report["overall"]["count"] == 3
+    assert report["overall"]["found"] == 2
+    assert report["types"]["earliest"]["p50_ms"] <= report["types"]["earliest"]["p99_ms"]
+    assert set(report["types"]) == {"earliest", "economy", "first"}
+    bounds = report["caches"]["reach_bounds"]
+    assert bounds["hits"] + bounds["misses"] == 3 and bounds["misses"] >= 2
+    assert report["caches"]["lazy_blocks"]["misses"] >= 1
+
+
+def test_cli_compare_deadline_ms(tmp_path: Path, capsys):
+    path = tmp_path / "tiny.txt"
+    path.write_text(
+        "ICN NRT FW101 08:00 10:00 300 800 1500\n"
+        "NRT SFO FW102 11:30 19:30 500 1200 2000\n"
+        "ICN SFO FW103 09:00 19:00 700 1500 2500\n",
+        encoding="utf-8",
+    )
+    main(["compare", str(path), "ICN", "SFO", "07:00"])
+    exact = capsys.readouterr().out
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--deadline-ms", "1000"])
+    assert capsys.readouterr().out == exact
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--epsilon", "0.1"])
+    assert capsys.readouterr().out == exact
+
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--deadline-ms", "50", "--day", "mon"])
+    assert "cannot be combined" in capsys.readouterr().out
+
+
+def test_cli_compare_avoid_and_no_red_eye(tmp_path: Path, capsys):
+    path = tmp_path / "tiny.txt"
+    path.write_text(
+        "ICN NRT FW101 08:00 10:00 300 800 1500\n"
+        "NRT SFO FW102 11:30 19:30 300 1200 2000\n"
+        "ICN SFO KE103 23:00 08:00+1 900 1500 2500\n",
+        encoding="utf-8",
+    )
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--avoid", "TYO", "--engine", "dijkstra"])
+    out = capsys.readouterr().out
+    assert out.count("23:00") == 4 and "08:00 " not in out
+    assert "no valid itinerary" not in out
+
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--avoid", "NRT", "--no-red-eye"])
+    assert capsys.readouterr().out.count("no valid itinerary") == 4
+
+    # Designators are case-insensitive.
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--avoid-carrier", "fw"])
+    out = capsys.readouterr().out
+    assert out.count("23:00") == 4 and "no valid itinerary" not in out
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--avoid-carrier", "fw, KE"])
+    assert capsys.readouterr().out.count("no valid itinerary") == 4
+
+    main(["compare", str(path), "ICN", "SFO", "07:00", "--avoid-carrier", "fw, KE", "--max-price", "500"])
+    assert "cannot be combined" in capsys.readouterr().out
+
+
+def test_cli_loadtest_background_index(tmp_path: Path, capsys):
+    path = tmp_path / "tiny.txt"
+    path.write_text(
+        "ICN NRT FW101 08:00 10:00 300 800 1500\n"
+        "NRT SFO FW102 11:30 19:30 500 1200 2000\n",
+        encoding="utf-8",
+    )
+    main(["loadtest", str(path), "--sample", "20", "--seed", "3", "--background-index"])
+    report = json.loads(capsys.readouterr().out)
+    assert report["engine"] == "reach"
+    assert sum(report["answered_by"].values()) == 20
+    assert set(report["answered_by"]) <= {"dijkstra", "compiled", "reach"}
+    status = report["background_index"]
+    assert status["target"] == "reach" and status["error"] is None
@@ -3,10 +3,19 @@
 from __future__ import annotations
 
 from pathlib import Path
+import bz2
+import gzip
+import io
+import lzma
+import sys
 import textwrap
+import threading
+import time
 
 import pytest
 
+import flight_planner
+
 from flight_planner import (
     Flight,
     parse_time,
@@ -15,6 +24,14 @@ from flight_planner import (
     load_flights_txt,
     load_flights_csv,
     load_flights,
+    parse_day_offset_time,
+    parse_days,
+    format_days,
+    parse_weekday,
+    ALL_DAYS,
+    expand_schedule_paths,
+    iter_merged_flights,
+    load_query_log,
 )
 
 
@@ -129,3 +146,161 @@ def test_load_flights_dispatch_uses_extension(tmp_path: Path):
     assert len(flights_csv) == 1
     assert flights_txt[0].origin == "ICN"
     assert flights_csv[0].origin == "NRT"
+
+
+def test_day_offset_times_and_days_roundtrip():
+    assert parse_day_offset_time("06:30+1") == 24 * 60 + 390
+    assert format_time(24 * 60 + 390) == "06:30+1"
+    assert parse_day_offset_time("08:30") == 510
+    with pytest.raises(ValueError):
+        parse_day_offset_time("06:30+x")
+
+    assert parse_days("135") == 0b0010101
+    assert format_days(parse_days("246")) == "246"
+    assert parse_days("1234567") == ALL_DAYS
+    for bad in ("", "8", "1a"):
+        with pytest.raises(ValueError):
+            parse_days(bad)
+
+    assert parse_weekday("fri") == 4
+    with pytest.raises(ValueError):
+        parse_weekday("xyz")
+
+
+def test_parse_flight_line_txt_overnight_with_days():
+    f = parse_flight_line_txt("ICN LHR FW900 23:00 05:30+1 700 1800 3200 57")
+    assert f.depart == 23 * 60
+    assert f.arrive == 24 * 60 + 330
+    assert f.days == parse_days("57")
+    assert f.operates_on(4) and f.operates_on(6)
+    assert not f.operates_on(0)
+
+    # Without a '+D' marker an earlier arrival is still rejected.
+    with pytest.raises(ValueError):
+        parse_flight_line_txt("ICN LHR FW900 23:00 05:30 700 1800 3200")
+
+
+def test_load_flights_csv_optional_days_column(tmp_path: Path):
+    path = tmp_path / "weekly.csv"
+    path.write_text(
+        "origin,dest,flight_number,depart,arrive,economy,business,first,days\n"
+        "ICN,NRT,FW101,08:00,10:00,300,800,1500,135\n"
+        "NRT,ICN,FW102,23:00,01:00+1,320,820,1520,\n",
+        encoding="utf-8",
+    )
+    flights = load_flights_csv(str(path))
+    assert flights[0].days == parse_days("135")
+    assert flights[1].days == ALL_DAYS
+    assert flights[1].arrive == 25 * 60
+
+
+def write_carrier_files(tmp_path: Path) -> Path:
+    carriers = tmp_path / "carriers"
+    carriers.mkdir()
+    (carriers / "fw.txt").write_text(
+        "ICN NRT FW101 09:00 11:00 300 800 1500\n"
+        "ICN NRT FW100 07:00 09:00 310 810 1510\n",
+        encoding="utf-8",
+    )
+    (carriers / "ke.csv").write_text(
+        "origin,dest,flight_number,depart,arrive,economy,business,first\n"
+        "NRT,SFO,KE202,12:00,20:00,500,1100,2000\n"
+        "ICN,SFO,KE201,08:00,18:00,700,1500,2500\n",
+        encoding="utf-8",
+    )
+    (carriers / "notes.md").write_text("not a schedule\n", encoding="utf-8")
+    return carriers
+
+
+def test_iter_merged_flights_departure_order(tmp_path: Path):
+    carriers = write_carrier_files(tmp_path)
+    files = expand_schedule_paths([str(carriers)])
+    assert [Path(p).name for p in files] == ["fw.txt", "ke.csv"]
+
+    merged = list(iter_merged_flights(files))
+    assert [fl.flight_number for fl in merged] == ["FW100", "KE201", "FW101", "KE202"]
+    # A directory also works through the plain load_flights() entry point.
+    assert load_flights(str(carriers)) == merged
+
+    with pytest.raises(FileNotFoundError):
+        expand_schedule_paths([str(tmp_path / "missing.txt")])
+    with pytest.raises(ValueError, match="more than once"):
+        expand_schedule_paths(["-", str(carriers), "-"])
+
+
+def test_prefetch_blocks_does_not_wait_for_a_blocked_reader():
+    release = threading.Event()
+
+    class SlowPipe(io.RawIOBase):
+        def __init__(self) -> None:
+            self.sent = False
+
+        def read(self, size: int = -1) -> bytes:
+            if not self.sent:
+                self.sent = True
+                return b"ICN SFO KE201 10:00 20:00 1 2 3\n"
+            release.wait(10)  # a pipe with no more data yet
+            return b""
+
+    blocks = flight_planner._prefetch_blocks(SlowPipe(), 64)
+    assert next(blocks).startswith(b"ICN")
+    start = time.perf_counter()
+    blocks.close()  # e.g. the caller hit a parse error
+    assert time.perf_counter() - start < 2
+    release.set()
+
+
+def test_iter_merged_flights_detects_duplicate_numbers(tmp_path: Path):
+    carriers = write_carrier_files(tmp_path)
+    dup = tmp_path / "dup.txt"
+    dup.write_text("ICN PEK KE201 10:00 11:00 100 200 300\n", encoding="utf-8")
+    with pytest.raises(ValueError, match="KE201"):
+        iter_merged_flights(expand_schedule_paths([str(carriers), str(dup)]))
+
+
+def test_load_query_log(tmp_path: Path):
+    path = tmp_path / "queries.txt"
+    path.write_text(
+        "# replayed traffic\n"
+        "ICN SFO 07:00\n"
+        "\n"
+        "ICN NRT 08:30 business\n",
+        encoding="utf-8",
+    )
+    assert load_query_log(str(path)) == [
+        ("ICN", "SFO", parse_time("07:00"), None),
+        ("ICN", "NRT", parse_time("08:30"), "business"),
+    ]
+
+    path.write_text("ICN SFO 07:00 premium\n", encoding="utf-8")
+    with pytest.raises(ValueError, match="queries.txt:1: unknown query type 'premium'"):
+        load_query_log(str(path))
+
+
+def test_load_flights_compressed_and_stdin(tmp_path: Path, monkeypatch):
+    txt = "# feed\nICN NRT FW101 08:00 10:00 300 800 1500\nNRT SFO FW102 11:30 19:30 500 1200 2000\n"
+    csv_text = (
+        "origin,dest,flight_number,depart,arrive,economy,business,first\n"
+        "NRT,ICN,FW103,11:00,13:00,320,820,1520\n"
+    )
+    (tmp_path / "a.txt.gz").write_bytes(gzip.compress(txt.encode()))
+    (tmp_path / "b.csv.bz2").write_bytes(bz2.compress(csv_text.encode()))
+    (tmp_path / "c.txt.xz").write_bytes(lzma.compress(txt.replace("FW10", "XZ10").encode()))
+
+    assert [fl.flight_number for fl in load_flights(str(tmp_path / "a.txt.gz"))] == ["FW101", "FW102"]
+    assert load_flights(str(tmp_path / "b.csv.bz2"))[0].dest == "ICN"
+    assert len(load_flights(str(tmp_path))) == 5  # directory picks up compressed files
+
+    # Tiny blocks: lines are split across block boundaries.
+    monkeypatch.setattr(flight_planner, "SCHEDULE_BLOCK_SIZE", 7)
+    assert [fl.flight_number for fl in load_flights(str(tmp_path / "c.txt.xz"))] == ["XZ101", "XZ102"]
+
+    monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(io.BytesIO(csv_text.encode())))
+    assert [fl.flight_number for fl in load_flights("-")] == ["FW103"]
+    monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(io.BytesIO(b"ICN NRT FW101 08:00 07:00 1 2 3\n")))
+    with pytest.raises(ValueError, match="<stdin>:1:"):
+        load_flights("-")
+
+    (tmp_path / "broken.txt.gz").write_bytes(gzip.compress(txt.encode())[:-12])
+    with pytest.raises(ValueError, match="broken.txt.gz: cannot read schedule"):
+        load_flights(str(tmp_path / "broken.txt.gz"))